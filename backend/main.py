@@ -4,34 +4,48 @@ Minimal Chromium footprint to stay within 512MB RAM limit.
 """
 
 import asyncio
-import json
+import logging
 import re
+import sys
 import zipfile
 import io
+from collections.abc import Iterator
 from datetime import datetime, timezone
 
+import ahocorasick
+import lxml.html
+import msgspec
+from cachetools import TTLCache
+from lxml import etree
+
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel, field_validator
 
+logger = logging.getLogger(__name__)
+
 try:
     from playwright.async_api import async_playwright, TimeoutError as PlaywrightTimeout
     PLAYWRIGHT_OK = True
 except ImportError:
     PLAYWRIGHT_OK = False
 
-try:
-    from bs4 import BeautifulSoup
-    BS4_OK = True
-except ImportError:
-    BS4_OK = False
-
 
 # ══════════════════════════════════════════════
 # MODELS
 # ══════════════════════════════════════════════
 
+# Accepted share-link prefixes; the id must start right after one of them
+_SHARE_PREFIXES = tuple(
+    f"{scheme}://{host}/{kind}/"
+    for scheme in ("https", "http")
+    for host in ("chatgpt.com", "chat.openai.com")
+    for kind in ("share", "c")
+)
+_SHARE_ID = re.compile(r"[a-zA-Z0-9\-]+")
+
+
 class ConvertRequest(BaseModel):
     url: str
 
@@ -39,44 +53,119 @@ class ConvertRequest(BaseModel):
     @classmethod
     def validate_url(cls, v: str) -> str:
         v = v.strip()
-        if not re.match(r"^https?://(chat\.openai\.com|chatgpt\.com)/(share|c)/[a-zA-Z0-9\-]+", v):
+        prefix = next((p for p in _SHARE_PREFIXES if v.startswith(p)), None)
+        if prefix is None or not _SHARE_ID.match(v, len(prefix)):
             raise ValueError("Only public ChatGPT share links are supported.")
         return v
 
 
+# Conversations travel column-wise: parallel role / content / code-block
+# lists. Roles are interned so they can be compared by identity.
+_USER, _ASSISTANT = sys.intern("user"), sys.intern("assistant")
+_ROLES = {"user": _USER, "assistant": _ASSISTANT}
+
+Messages = tuple[list[str], list[str], list[list[str]]]
+
+
+# Response models; msgspec encodes them in C, in field order
+class Msg(msgspec.Struct):
+    role: str
+    content: str
+    code_blocks: list[str] = []
+
+
+class Meta(msgspec.Struct):
+    source: str
+    source_url: str
+    captured_at: str
+    topic: str
+    message_count: int
+    user_turns: int
+    assistant_turns: int
+    code_block_count: int
+    word_count: int
+    transit_version: str
+    demo_mode: bool | msgspec.UnsetType = msgspec.UNSET
+
+
+class TransitJSON(msgspec.Struct):
+    source: str
+    source_url: str
+    captured_at: str
+    topic: str
+    messages: list[Msg]
+
+
 # ══════════════════════════════════════════════
 # MODULE 1 — RENDERER (memory-optimized)
 # ══════════════════════════════════════════════
 
-async def render_page(url: str) -> str:
+# Chromium and one BrowserContext are created at startup and shared; share
+# pages need no auth state, so each request only opens a page. Cap
+# concurrent pages to fit in 512MB.
+MAX_PAGES = 2
+_page_slots = asyncio.Semaphore(MAX_PAGES)
+
+# Hard cap on rendered HTML. Long share pages run 1–2M characters, so this
+# leaves ample headroom; anything larger is refused, never truncated.
+MAX_HTML_CHARS = 8_000_000
+
+# Heavy resources are blocked by Playwright's own request classification;
+# the regex is only left to catch tracker scripts and beacons.
+_BLOCK_TYPES = frozenset(("image", "media", "font", "stylesheet"))
+_TRACKER_RE = re.compile(r"/(analytics|tracking|hotjar|sentry)", re.IGNORECASE)
+
+
+async def _filter_route(route) -> None:
+    request = route.request
+    if request.resource_type in _BLOCK_TYPES or _TRACKER_RE.search(request.url):
+        await route.abort()
+    else:
+        await route.continue_()
+
+
+MESSAGE_SELECTOR = "[data-message-id], [data-message-author-role], article"
+# Settled = document parsed, nothing streaming, and the message count
+# unchanged since the previous poll (so it must hold across two polls).
+MESSAGES_SETTLED_JS = f"""() => {{
+    if (document.readyState === 'loading') return false;
+    const n = document.querySelectorAll('{MESSAGE_SELECTOR}').length;
+    const last = window.__transitLastCount;
+    window.__transitLastCount = n;
+    return n > 0 && n === last
+        && !document.querySelector('[data-message-is-streaming="true"]');
+}}"""
+SETTLE_POLL_MS = 500
+
+CHROMIUM_ARGS = [
+    "--no-sandbox",
+    "--disable-dev-shm-usage",      # Critical for low-memory envs
+    "--disable-gpu",
+    "--disable-software-rasterizer",
+    "--disable-extensions",
+    "--disable-background-networking",
+    "--disable-default-apps",
+    "--disable-sync",
+    "--disable-translate",
+    "--hide-scrollbars",
+    "--metrics-recording-only",
+    "--mute-audio",
+    "--no-first-run",
+    "--safebrowsing-disable-auto-update",
+    "--memory-pressure-off",
+    "--js-flags=--max-old-space-size=256",  # Cap JS heap
+]
+
+
+async def launch_browser():
     """
-    Launch Chromium with aggressive memory-saving flags
-    to stay within Render's 512MB free tier limit.
+    Start Playwright, a long-lived headless Chromium and the shared context.
+    No --single-process: the browser now outlives requests, so stability wins.
     """
-    async with async_playwright() as pw:
-        browser = await pw.chromium.launch(
-            headless=True,
-            args=[
-                "--no-sandbox",
-                "--disable-dev-shm-usage",      # Critical for low-memory envs
-                "--disable-gpu",
-                "--disable-software-rasterizer",
-                "--disable-extensions",
-                "--disable-background-networking",
-                "--disable-default-apps",
-                "--disable-sync",
-                "--disable-translate",
-                "--hide-scrollbars",
-                "--metrics-recording-only",
-                "--mute-audio",
-                "--no-first-run",
-                "--safebrowsing-disable-auto-update",
-                "--single-process",             # Saves ~100MB RAM (risk: less stable)
-                "--memory-pressure-off",
-                "--js-flags=--max-old-space-size=256",  # Cap JS heap
-            ],
-        )
-
+    pw = await async_playwright().start()
+    browser = None
+    try:
+        browser = await pw.chromium.launch(headless=True, args=CHROMIUM_ARGS)
         ctx = await browser.new_context(
             user_agent=(
                 "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
@@ -86,32 +175,41 @@ async def render_page(url: str) -> str:
             java_script_enabled=True,
             bypass_csp=True,
         )
-
         # Block heavy resources to save memory + speed up load
-        await ctx.route(
-            "**/*.{png,jpg,jpeg,gif,webp,svg,ico,woff,woff2,ttf,mp4,mp3}",
-            lambda route: route.abort()
-        )
-        await ctx.route("**/analytics**", lambda route: route.abort())
-        await ctx.route("**/tracking**", lambda route: route.abort())
-        await ctx.route("**/hotjar**", lambda route: route.abort())
-        await ctx.route("**/sentry**", lambda route: route.abort())
-
-        page = await ctx.new_page()
-
+        await ctx.route("**/*", _filter_route)
+    except Exception:
+        # Don't leak the Node driver (or a half-started Chromium) per retry
+        for close in (browser and browser.close, pw.stop):
+            if close:
+                try:
+                    await close()
+                except Exception:
+                    pass
+        raise
+    return pw, browser, ctx
+
+
+async def render_page(ctx, url: str) -> str:
+    """
+    Render a share page in a fresh page on the shared context.
+    """
+    async with _page_slots:
+        page = None
         try:
-            await page.goto(url, wait_until="domcontentloaded", timeout=40_000)
+            page = await ctx.new_page()
+            # Return as soon as the response commits; the waits below decide readiness
+            await page.goto(url, wait_until="commit", timeout=40_000)
+            await page.wait_for_load_state("domcontentloaded", timeout=40_000)
 
-            # Wait for message content
+            # Wait for message content, then for the message DOM to stop changing
             try:
-                await page.wait_for_selector(
-                    "[data-message-id], [data-message-author-role], article",
-                    timeout=25_000,
+                await page.wait_for_selector(MESSAGE_SELECTOR, timeout=25_000)
+                await page.wait_for_function(
+                    MESSAGES_SETTLED_JS, polling=SETTLE_POLL_MS, timeout=10_000,
                 )
             except PlaywrightTimeout:
                 pass  # Try parsing anyway
 
-            await asyncio.sleep(2)
             html = await page.content()
 
         except PlaywrightTimeout:
@@ -122,10 +220,14 @@ async def render_page(url: str) -> str:
         except Exception as e:
             raise HTTPException(status_code=502, detail=f"Renderer error: {str(e)}")
         finally:
-            await page.close()
-            await ctx.close()
-            await browser.close()
+            if page is not None:
+                await page.close()
 
+    if len(html) > MAX_HTML_CHARS:
+        raise HTTPException(
+            status_code=413,
+            detail="Conversation is too large to convert.",
+        )
     return html
 
 
@@ -133,67 +235,110 @@ async def render_page(url: str) -> str:
 # MODULE 2 — EXTRACTOR
 # ══════════════════════════════════════════════
 
+_BLANK_RUN = re.compile(r"\n{3,}")
+
+
+# Containers whose text never counts as message content
+_SKIP_TEXT_TAGS = ("script", "style", "template")
+# Page chrome plus the above, emptied before reading text
+_STRIP_TAGS = ("button", "svg", "nav", "header", "footer", "form", *_SKIP_TEXT_TAGS)
+
+_HTML_PARSER = lxml.html.HTMLParser(
+    remove_comments=True,
+    remove_blank_text=True,
+    collect_ids=False,
+)
+# lxml refuses str input that carries an encoding declaration
+_XML_DECL = re.compile(r"\s*<\?xml[^>]*\?>")
+# Compiled once, evaluated in C
+_XP_MSG = etree.XPath("//*[@data-message-author-role]")
+_XP_PROSE = etree.XPath(".//*[contains(@class,'prose') or contains(@class,'markdown')]")
+_XP_ARTICLE = etree.XPath("//article")
+_XP_GROUP = etree.XPath("//*[contains(concat(' ', normalize-space(@class), ' '), ' group ')]")
+_XP_CODE = etree.XPath(".//code")
+
+
+def element_text(el) -> str:
+    """Stripped, non-empty text nodes joined by newlines."""
+    return "\n".join(t for t in (s.strip() for s in el.itertext()) if t)
+
+
 def extract_code_blocks(el) -> tuple[str, list[str]]:
+    # One walk classifies the subtree; mutate only after iteration ends
+    pres, chrome = [], []
+    for tag in el.iterdescendants("pre", *_STRIP_TAGS):
+        (pres if tag.tag == "pre" else chrome).append(tag)
+
     codes = []
-    for pre in el.find_all("pre"):
-        code = pre.find("code") or pre
-        lang = ""
-        if code.get("class"):
-            for c in code.get("class", []):
-                if c.startswith("language-"):
-                    lang = c.replace("language-", "")
-        text = code.get_text().strip()
+    for pre in pres:
+        code = (_XP_CODE(pre) or [pre])[0]
+        lang = next(
+            (c[9:] for c in (code.get("class") or "").split() if c.startswith("language-")),
+            "",
+        )
+        text = code.text_content().strip()
         codes.append(text)
-        pre.replace_with(f"\n```{lang}\n{text}\n```\n")
+        pre.clear(keep_tail=True)
+        pre.text = f"\n```{lang}\n{text}\n```\n"
 
-    for tag in el.find_all(["button", "svg", "nav", "header", "footer", "form"]):
-        tag.decompose()
+    # clear() rather than drop_tree(): the tail must stay its own text node,
+    # or it gets glued onto the preceding text without a newline
+    for tag in chrome:
+        tag.clear(keep_tail=True)
 
-    content = el.get_text(separator="\n", strip=True)
-    content = re.sub(r"\n{3,}", "\n\n", content).strip()
+    content = _BLANK_RUN.sub("\n\n", element_text(el)).strip()
     return content, codes
 
 
-def extract_messages(html: str) -> list[dict]:
-    soup = BeautifulSoup(html, "html.parser")
-    messages = []
+def extract_messages(html: str) -> Messages:
+    roles, contents, code_blocks = messages = [], [], []
+    decl = _XML_DECL.match(html)
+    if decl:
+        html = html[decl.end():]
+    if not html.strip():
+        return messages
+    root = lxml.html.document_fromstring(html, parser=_HTML_PARSER)
 
     # Strategy A: modern ChatGPT DOM
-    els = soup.find_all(attrs={"data-message-author-role": True})
+    els = _XP_MSG(root)
     if els:
         for el in els:
-            role = el.get("data-message-author-role", "").lower()
-            if role not in ("user", "assistant"):
+            role = _ROLES.get(el.get("data-message-author-role", "").lower())
+            if role is None:
                 continue
-            prose = el.find(class_=re.compile(r"prose|markdown")) or el
+            prose = (_XP_PROSE(el) or [el])[0]
             text, codes = extract_code_blocks(prose)
             if text:
-                messages.append({"role": role, "content": text, "code_blocks": codes})
-        if messages:
+                roles.append(role)
+                contents.append(text)
+                code_blocks.append(codes)
+        if roles:
             return messages
 
     # Strategy B: article elements
-    articles = soup.find_all("article")
+    articles = _XP_ARTICLE(root)
     if articles:
         for i, art in enumerate(articles):
             text, codes = extract_code_blocks(art)
             if text and len(text) > 10:
-                messages.append({
-                    "role": "user" if i % 2 == 0 else "assistant",
-                    "content": text,
-                    "code_blocks": codes,
-                })
-        if messages:
+                roles.append(_USER if i % 2 == 0 else _ASSISTANT)
+                contents.append(text)
+                code_blocks.append(codes)
+        if roles:
             return messages
 
     # Strategy C: .group divs
     seen = set()
-    for g in soup.select(".group.w-full, .group"):
-        text = g.get_text(separator="\n", strip=True)
+    for g in _XP_GROUP(root):
+        for tag in g.iterdescendants(*_SKIP_TEXT_TAGS):
+            tag.clear(keep_tail=True)
+        text = element_text(g)
         key = text[:60]
         if len(text) > 20 and key not in seen:
             seen.add(key)
-            messages.append({"role": "user", "content": text, "code_blocks": []})
+            roles.append(_USER)
+            contents.append(text)
+            code_blocks.append([])
 
     return messages
 
@@ -202,20 +347,49 @@ def extract_messages(html: str) -> list[dict]:
 # MODULE 3 — NORMALIZATION
 # ══════════════════════════════════════════════
 
-_NOISE = re.compile(
-    r"(Copy code|Copy|Regenerate|Edit message|Like|Dislike|"
-    r"Report|Try again|Stop generating|ChatGPT|GPT-4|GPT-3\.5)",
-    re.IGNORECASE,
+_NOISE_WORDS = (
+    "Copy code", "Copy", "Regenerate", "Edit message", "Like", "Dislike",
+    "Report", "Try again", "Stop generating", "ChatGPT", "GPT-4", "GPT-3.5",
 )
+# Only for text whose lower() changes length, where automaton offsets break
+_NOISE_RE = re.compile("|".join(map(re.escape, _NOISE_WORDS)), re.IGNORECASE)
 
-def normalize(messages: list[dict]) -> list[dict]:
-    out = []
-    for m in messages:
-        text = _NOISE.sub("", m["content"])
-        text = re.sub(r"\n{3,}", "\n\n", text)
-        text = re.sub(r"[ \t]{2,}", " ", text).strip()
+# One automaton scan finds every noise keyword; iter_long keeps the
+# leftmost-longest, non-overlapping hits, which is what _NOISE_RE picks.
+_NOISE_AC = ahocorasick.Automaton()
+for _w in _NOISE_WORDS:
+    _NOISE_AC.add_word(_w.lower(), len(_w))
+_NOISE_AC.make_automaton()
+
+_WS = re.compile(r"(\n{3,})|([ \t]{2,})")
+
+
+def _ws_sub(m: re.Match) -> str:
+    return "\n\n" if m.group(1) else " "
+
+
+def strip_noise(text: str) -> str:
+    lowered = text.lower()
+    if len(lowered) != len(text):  # lower() shifted offsets (rare Unicode)
+        return _NOISE_RE.sub("", text)
+    pieces, pos = [], 0
+    for end, length in _NOISE_AC.iter_long(lowered):
+        pieces.append(text[pos:end - length + 1])
+        pos = end + 1
+    if not pieces:
+        return text
+    pieces.append(text[pos:])
+    return "".join(pieces)
+
+
+def normalize(messages: Messages) -> Messages:
+    roles, contents, code_blocks = out = [], [], []
+    for role, content, codes in zip(*messages):
+        text = _WS.sub(_ws_sub, strip_noise(content)).strip()
         if text:
-            out.append({**m, "content": text})
+            roles.append(role)
+            contents.append(text)
+            code_blocks.append(codes)
     return out
 
 
@@ -223,91 +397,191 @@ def normalize(messages: list[dict]) -> list[dict]:
 # MODULE 4 — CONTEXT BUILDER
 # ══════════════════════════════════════════════
 
-def detect_topic(messages: list[dict]) -> str:
-    first = next((m for m in messages if m["role"] == "user"), None)
+def detect_topic(messages: Messages) -> str:
+    roles, contents, _ = messages
+    first = next((c for r, c in zip(roles, contents) if r is _USER), None)
     if not first:
         return "General Conversation"
-    return first["content"].split("\n")[0].strip()[:90]
+    return first.split("\n")[0].strip()[:90]
+
+
+def build_metadata(url: str, messages: Messages, topic: str) -> Meta:
+    roles, contents, code_blocks = messages
+    user_turns = code_count = word_count = 0
+    for role, content, codes in zip(roles, contents, code_blocks):
+        if role is _USER:
+            user_turns += 1
+        code_count += len(codes)
+        word_count += len(content.split())
+    return Meta(
+        source="ChatGPT Shared Link",
+        source_url=url,
+        captured_at=datetime.now(timezone.utc).isoformat(),
+        topic=topic,
+        message_count=len(roles),
+        user_turns=user_turns,
+        assistant_turns=len(roles) - user_turns,
+        code_block_count=code_count,
+        word_count=word_count,
+        transit_version="1.0.0",
+    )
+
+
+def build_summary(messages: Messages, meta: Meta) -> str:
+    roles, contents, _ = messages
+    users = [c for r, c in zip(roles, contents) if r is _USER]
+    opening = users[0][:300] if users else "N/A"
+    closing = users[-1][:300] if len(users) > 1 else ""
+    buf = io.StringIO()
+    w = buf.write
+    w("╔══════════════════════════════════════════════════════════╗\n")
+    w("║           CHAT TRANSIT — CONTEXT SUMMARY                ║\n")
+    w("╚══════════════════════════════════════════════════════════╝\n\n")
+    w(f"Topic      : {meta.topic}\n")
+    w(f"Captured   : {meta.captured_at}\n")
+    w(f"Source     : {meta.source_url}\n")
+    w(f"Messages   : {meta.message_count} "
+      f"({meta.user_turns} user / {meta.assistant_turns} assistant)\n")
+    w(f"Words      : {meta.word_count:,}\n")
+    w(f"Code blocks: {meta.code_block_count}\n\n")
+    w("── OPENING QUERY ──────────────────────────────────────────\n\n")
+    w(f"  {opening}{'...' if len(opening)==300 else ''}\n")
+    if closing:
+        w("\n── FINAL QUERY ────────────────────────────────────────────\n\n")
+        w(f"  {closing}{'...' if len(closing)==300 else ''}\n")
+    w("\n── HOW TO USE ─────────────────────────────────────────────\n\n")
+    w("  Upload transit.md or transit.json to your target LLM.\n")
+    w("  Use this file as a system prompt preamble.\n\n")
+    w("──────────────────────────────────────────────────────────\n")
+    w("Generated by Chat Transit v1.0  •  AI Memory Portability")
+    return buf.getvalue()
+
+
+def build_markdown(messages: Messages, meta: Meta) -> str:
+    roles, contents, _ = messages
+    buf = io.StringIO()
+    w = buf.write
+    w("# Chat Transit Export\n\n")
+    w(f"> **Source:** {meta.source_url}  \n")
+    w(f"> **Topic:** {meta.topic}  \n")
+    w(f"> **Captured:** {meta.captured_at}\n\n---\n")
+    labels = {_USER: "👤 USER", _ASSISTANT: "🤖 ASSISTANT"}
+    last = len(roles) - 1
+    for i, (role, content) in enumerate(zip(roles, contents)):
+        w(f"\n## {labels.get(role, role.upper())}\n\n")
+        w(content)
+        w("\n")
+        if i < last:
+            w("\n---\n")
+    return buf.getvalue()
+
+
+def build_transit_json(messages: Messages, meta: Meta) -> TransitJSON:
+    return TransitJSON(
+        source=meta.source,
+        source_url=meta.source_url,
+        captured_at=meta.captured_at,
+        topic=meta.topic,
+        # Rows are only rebuilt here, at the serialization boundary
+        messages=[Msg(r, c, k) for r, c, k in zip(*messages)],
+    )
+
+
+_encoder = msgspec.json.Encoder()
+
+
+def stream_package(messages: Messages, meta: Meta, stats: dict) -> Iterator[bytes]:
+    """
+    Encode the convert response piece by piece so only one artifact
+    is alive at a time instead of the whole JSON envelope.
+    """
+    encode = _encoder.encode
+    yield b'{"transit_json":'
+    yield encode(build_transit_json(messages, meta))
+    yield b',"transit_md":'
+    yield encode(build_markdown(messages, meta))
+    yield b',"summary_txt":'
+    yield encode(build_summary(messages, meta))
+    yield b',"metadata_json":'
+    yield encode(meta)
+    yield b',"stats":'
+    yield encode(stats)
+    yield b"}"
 
 
-def build_metadata(url: str, messages: list[dict], topic: str) -> dict:
-    user_turns = sum(1 for m in messages if m["role"] == "user")
-    code_count = sum(len(m.get("code_blocks", [])) for m in messages)
-    word_count = sum(len(m["content"].split()) for m in messages)
-    return {
-        "source": "ChatGPT Shared Link",
-        "source_url": url,
-        "captured_at": datetime.now(timezone.utc).isoformat(),
-        "topic": topic,
-        "message_count": len(messages),
-        "user_turns": user_turns,
-        "assistant_turns": len(messages) - user_turns,
-        "code_block_count": code_count,
-        "word_count": word_count,
-        "transit_version": "1.0.0",
-    }
+# ══════════════════════════════════════════════
+# MODULE 5 — PIPELINE + CACHE
+# ══════════════════════════════════════════════
 
+# Share pages are immutable, so a repeat URL skips Chromium entirely.
+# Entries hold the extracted messages, not the encoded artifacts, to keep
+# the cache's RSS close to the size of the conversation text.
+PKG_CACHE_SIZE = 64
+PKG_CACHE_TTL = 3600
+_PKG_CACHE: TTLCache = TTLCache(maxsize=PKG_CACHE_SIZE, ttl=PKG_CACHE_TTL)
+# key -> [lock, number of requests holding or waiting on it]
+_url_locks: dict[str, list] = {}
 
-def build_summary(messages: list[dict], meta: dict) -> str:
-    users = [m for m in messages if m["role"] == "user"]
-    opening = users[0]["content"][:300] if users else "N/A"
-    closing = users[-1]["content"][:300] if len(users) > 1 else ""
-    lines = [
-        "╔══════════════════════════════════════════════════════════╗",
-        "║           CHAT TRANSIT — CONTEXT SUMMARY                ║",
-        "╚══════════════════════════════════════════════════════════╝",
-        "",
-        f"Topic      : {meta['topic']}",
-        f"Captured   : {meta['captured_at']}",
-        f"Source     : {meta['source_url']}",
-        f"Messages   : {meta['message_count']} "
-        f"({meta['user_turns']} user / {meta['assistant_turns']} assistant)",
-        f"Words      : {meta['word_count']:,}",
-        f"Code blocks: {meta['code_block_count']}",
-        "",
-        "── OPENING QUERY ──────────────────────────────────────────",
-        "",
-        f"  {opening}{'...' if len(opening)==300 else ''}",
-    ]
-    if closing:
-        lines += ["", "── FINAL QUERY ────────────────────────────────────────────",
-                  "", f"  {closing}{'...' if len(closing)==300 else ''}"]
-    lines += [
-        "", "── HOW TO USE ─────────────────────────────────────────────",
-        "",
-        "  Upload transit.md or transit.json to your target LLM.",
-        "  Use this file as a system prompt preamble.",
-        "",
-        "──────────────────────────────────────────────────────────",
-        "Generated by Chat Transit v1.0  •  AI Memory Portability",
-    ]
-    return "\n".join(lines)
-
-
-def build_markdown(messages: list[dict], meta: dict) -> str:
-    lines = [
-        "# Chat Transit Export", "",
-        f"> **Source:** {meta['source_url']}  ",
-        f"> **Topic:** {meta['topic']}  ",
-        f"> **Captured:** {meta['captured_at']}",
-        "", "---", "",
-    ]
-    labels = {"user": "👤 USER", "assistant": "🤖 ASSISTANT"}
-    for i, m in enumerate(messages):
-        lines += [f"## {labels.get(m['role'], m['role'].upper())}", "", m["content"], ""]
-        if i < len(messages) - 1:
-            lines += ["---", ""]
-    return "\n".join(lines)
-
-
-def build_transit_json(messages: list[dict], meta: dict) -> dict:
-    return {
-        "source": meta["source"],
-        "source_url": meta["source_url"],
-        "captured_at": meta["captured_at"],
-        "topic": meta["topic"],
-        "messages": messages,
+
+def cache_key(url: str) -> str:
+    """
+    host/kind/id of a validated share URL, so scheme, trailing paths and
+    query strings don't split one conversation across cache entries.
+    """
+    prefix = next(p for p in _SHARE_PREFIXES if url.startswith(p))
+    share_id = _SHARE_ID.match(url, len(prefix)).group()
+    return prefix.split("://", 1)[1] + share_id
+
+
+async def build_package(get_ctx, url: str) -> tuple[Messages, Meta, dict]:
+    html = await render_page(await get_ctx(), url)
+    # Parsing is CPU-bound; keep the event loop free for other renders
+    raw = await asyncio.to_thread(extract_messages, html)
+
+    if not raw[0]:
+        raise HTTPException(
+            status_code=422,
+            detail="No messages found. Link may be private, expired, or unsupported.",
+        )
+
+    messages = await asyncio.to_thread(normalize, raw)
+    topic = detect_topic(messages)
+    meta = build_metadata(url, messages, topic)
+    stats = {
+        "messages": meta.message_count,
+        "turns": meta.user_turns,
+        "code_blocks": meta.code_block_count,
+        "words": meta.word_count,
+        "demo": False,
     }
+    return messages, meta, stats
+
+
+async def get_package(get_ctx, url: str) -> tuple[Messages, Meta, dict]:
+    """
+    Cached build_package. Concurrent first hits on one URL share a lock,
+    so only one of them renders; the rest read the cache.
+    """
+    key = cache_key(url)
+    pkg = _PKG_CACHE.get(key)
+    if pkg is not None:
+        return pkg
+
+    entry = _url_locks.get(key)
+    if entry is None:
+        entry = _url_locks[key] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            pkg = _PKG_CACHE.get(key)
+            if pkg is None:
+                pkg = await build_package(get_ctx, url)
+                _PKG_CACHE[key] = pkg
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del _url_locks[key]
+    return pkg
 
 
 # ══════════════════════════════════════════════
@@ -321,25 +595,29 @@ DEMO_MESSAGES = [
     {"role": "assistant", "content": "Wrap it in BaseHTTPMiddleware:\n\n```python\nfrom starlette.middleware.base import BaseHTTPMiddleware\n\nclass RateLimitMiddleware(BaseHTTPMiddleware):\n    async def dispatch(self, request, call_next):\n        await rate_limit(request)\n        return await call_next(request)\n\napp.add_middleware(RateLimitMiddleware)\n```", "code_blocks": ["from starlette.middleware.base import BaseHTTPMiddleware..."]},
 ]
 
-def get_demo_package(url: str) -> dict:
+_DEMO_COLUMNS: Messages = (
+    [_ROLES[m["role"]] for m in DEMO_MESSAGES],
+    [m["content"] for m in DEMO_MESSAGES],
+    [m["code_blocks"] for m in DEMO_MESSAGES],
+)
+
+def get_demo_package(url: str) -> tuple[Messages, Meta, dict]:
     topic = "Redis Rate Limiter in FastAPI (Python)"
-    meta = build_metadata(url, DEMO_MESSAGES, topic)
-    meta["demo_mode"] = True
-    tj = build_transit_json(DEMO_MESSAGES, meta)
-    md = build_markdown(DEMO_MESSAGES, meta)
-    sm = build_summary(DEMO_MESSAGES, meta)
-    return {
-        "transit_json": tj, "transit_md": md,
-        "summary_txt": sm, "metadata_json": meta,
-        "stats": {"messages": 4, "turns": 2, "code_blocks": 2, "words": 180, "demo": True},
-    }
+    meta = build_metadata(url, _DEMO_COLUMNS, topic)
+    meta.demo_mode = True
+    stats = {"messages": 4, "turns": 2, "code_blocks": 2, "words": 180, "demo": True}
+    return _DEMO_COLUMNS, meta, stats
 
 
 # ══════════════════════════════════════════════
 # FASTAPI APP
 # ══════════════════════════════════════════════
 
-app = FastAPI(title="Chat Transit API", version="1.0.0")
+app = FastAPI(
+    title="Chat Transit API",
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -349,6 +627,70 @@ app.add_middleware(
 )
 
 
+_launch_lock = asyncio.Lock()
+
+
+def browser_alive() -> bool:
+    return (
+        app.state.browser is not None
+        and app.state.browser.is_connected()
+        and app.state.ctx is not None
+    )
+
+
+def _on_ctx_close(ctx) -> None:
+    if app.state.ctx is ctx:
+        app.state.ctx = None
+
+
+async def close_browser() -> None:
+    """Best-effort teardown; the browser may already be gone."""
+    ctx, browser, pw = app.state.ctx, app.state.browser, app.state.pw
+    app.state.pw = app.state.browser = app.state.ctx = None
+    for close in (ctx and ctx.close, browser and browser.close, pw and pw.stop):
+        if close:
+            try:
+                await close()
+            except Exception:
+                pass
+
+
+async def get_context():
+    """
+    Shared context for rendering. Relaunches Chromium if it was killed
+    (e.g. OOM on the free tier) or the context was closed.
+    """
+    if browser_alive():
+        return app.state.ctx
+    async with _launch_lock:
+        if not browser_alive():
+            await close_browser()
+            try:
+                pw, browser, ctx = await launch_browser()
+            except Exception as e:
+                raise HTTPException(status_code=502, detail=f"Renderer error: {str(e)}")
+            ctx.on("close", _on_ctx_close)
+            app.state.pw, app.state.browser, app.state.ctx = pw, browser, ctx
+    return app.state.ctx
+
+
+@app.on_event("startup")
+async def startup():
+    app.state.pw = app.state.browser = app.state.ctx = None
+    if PLAYWRIGHT_OK:
+        # Don't take /health and demo mode down with a failed launch;
+        # get_context retries on the first convert request.
+        try:
+            await get_context()
+        except Exception:
+            logger.exception("Chromium launch failed at startup")
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await close_browser()
+
+
 @app.get("/")
 async def root():
     return {"service": "Chat Transit API", "status": "ok", "version": "1.0.0"}
@@ -360,43 +702,20 @@ async def health():
         "status": "ok",
         "mode": "full" if PLAYWRIGHT_OK else "demo",
         "playwright": PLAYWRIGHT_OK,
-        "bs4": BS4_OK,
+        "browser": PLAYWRIGHT_OK and browser_alive(),
     }
 
 
 @app.post("/api/convert")
 async def convert(req: ConvertRequest):
     if not PLAYWRIGHT_OK:
-        return get_demo_package(req.url)
-
-    html = await render_page(req.url)
-    raw = extract_messages(html)
-
-    if not raw:
-        raise HTTPException(
-            status_code=422,
-            detail="No messages found. Link may be private, expired, or unsupported.",
-        )
-
-    messages = normalize(raw)
-    topic = detect_topic(messages)
-    meta = build_metadata(req.url, messages, topic)
-    users = sum(1 for m in messages if m["role"] == "user")
-    codes = sum(len(m.get("code_blocks", [])) for m in messages)
-
-    return {
-        "transit_json": build_transit_json(messages, meta),
-        "transit_md": build_markdown(messages, meta),
-        "summary_txt": build_summary(messages, meta),
-        "metadata_json": meta,
-        "stats": {
-            "messages": len(messages),
-            "turns": users,
-            "code_blocks": codes,
-            "words": meta["word_count"],
-            "demo": False,
-        },
-    }
+        messages, meta, stats = get_demo_package(req.url)
+    else:
+        messages, meta, stats = await get_package(get_context, req.url)
+    return StreamingResponse(
+        stream_package(messages, meta, stats),
+        media_type="application/json",
+    )
 
 
 if __name__ == "__main__":